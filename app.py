@@ -1,30 +1,67 @@
 import streamlit as st
 import pandas as pd
-import random
+import numpy as np
+import pyarrow as pa
 import time
+import gc
+import threading
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import SimpleNamespace
 import stripe
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from supabase import create_client, Client
 
 # ── CONFIG ────────────────────────────────────────────
 st.set_page_config(page_title="CRQBank", page_icon="📚", layout="wide")
 
+# Fewer automatic GC passes during click reruns; a full collection runs
+# when a test is submitted instead.
+gc.set_threshold(50_000, 20, 20)
+
 # ── CACHED DATA LOADER ─────────────────────────────────
-@st.cache_data
+# The question bank is read-only, so share one copy instead of cache_data's
+# per-call copy of the returned DataFrame.
+@st.cache_resource
 def load_questions(path: str) -> pd.DataFrame:
-    return pd.read_csv(path)
+    df = pd.read_csv(path)
+    # answers are stored as "A".."D"; option keys are "a".."d"
+    df["answer"] = df["answer"].str.strip().str.lower()
+    return df
+
+@st.cache_data
+def topic_stats(_df: pd.DataFrame) -> tuple[dict, list]:
+    counts = _df["topic"].value_counts().to_dict()
+    return counts, sorted(_df["topic"].unique().tolist())
+
+@st.cache_data
+def topic_index(_df: pd.DataFrame) -> dict:
+    return {t: g.to_numpy(dtype=np.int32) for t, g in _df.groupby("topic").groups.items()}
+
+@st.cache_resource
+def as_records(_df: pd.DataFrame) -> list[dict]:
+    return _df.to_dict("records")
+
+@st.cache_data
+def load_css(path: str) -> str:
+    with open(path) as f:
+        return f.read()
 
 # ── SESSION STATE INITIALIZER ──────────────────────────
 def init_state():
     defaults = {
         "user": None,
         "paid": False,
+        "checkout_seen": False,
         "total": 0,
         "correct": 0,
         "start_time": None,
         "question_list": [],
         "current_q_idx": 0,
         "responses": [],
+        "pending_writes": [],
         "locked_mode": None,
         "locked_test_mode": None,
         "test_submitted": False,
@@ -32,7 +69,78 @@ def init_state():
     for k, v in defaults.items():
         st.session_state.setdefault(k, v)
 
+# ── IDLE SESSION CLEANUP ───────────────────────────────
+# Streamlit keeps session_state alive after a tab goes away, so sessions
+# idle for longer than SESSION_TTL have their test data dropped.
+SESSION_TTL    = 30 * 60
+SWEEP_INTERVAL = 60
+HEAVY_KEYS     = (
+    "question_list", "responses", "current_q_idx",
+    "locked_mode", "locked_test_mode", "test_submitted",
+)
+
+@st.cache_resource
+def session_registry() -> dict:
+    return {"lock": threading.Lock(), "sessions": {}, "last_sweep": 0.0}
+
+@st.cache_resource
+def sweep_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-sweep")
+
+def touch_session():
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    registry = session_registry()
+    with registry["lock"]:
+        registry["sessions"][ctx.session_id] = time.time()
+
+def sweep_sessions():
+    # at most once per SWEEP_INTERVAL; the flush and eviction run off the request thread
+    registry = session_registry()
+    now      = time.time()
+    with registry["lock"]:
+        if now - registry["last_sweep"] < SWEEP_INTERVAL:
+            return
+        registry["last_sweep"] = now
+        sessions = registry["sessions"]
+        stale = [sid for sid, seen in sessions.items() if now - seen > SESSION_TTL]
+        for sid in stale:
+            del sessions[sid]
+    for sid in stale:
+        sweep_executor().submit(evict_session, sid)
+
+def evict_session(sid: str):
+    # Private API, checked against Streamlit 1.40: Runtime._session_mgr and
+    # SessionInfo.session.session_state. Closed sessions are already gone here.
+    info = runtime.get_instance()._session_mgr.get_session_info(sid)
+    if info is None:
+        return
+    state    = info.session.session_state
+    registry = session_registry()
+    pending  = list(state["pending_writes"]) if "pending_writes" in state else []
+    # unsaved answers go to Supabase first; on failure retry after another TTL
+    saved = save_responses(pending)
+    # a rerun touches the registry under this lock before reading its state,
+    # so a session that came back meanwhile is registered again and skipped
+    with registry["lock"]:
+        current = state["pending_writes"] if "pending_writes" in state else []
+        if saved and pending and current[:len(pending)] == pending:
+            state["pending_writes"] = current[len(pending):]
+        if sid in registry["sessions"]:
+            return
+        if not saved:
+            registry["sessions"][sid] = time.time()
+            return
+        for k in HEAVY_KEYS:
+            if k in state:
+                del state[k]
+
 # ── SUPABASE AUTH SETUP ───────────────────────────────
+# One client per process, shared by every session and by the paid-flag
+# update. Its PostgREST httpx session pools connections, but supabase-py
+# rebuilds that session on auth events (sign-in, token refresh), and
+# sign_in/sign_up use this same client, so each login drops the pool.
 @st.cache_resource
 def get_supabase() -> Client:
     url = st.secrets["SUPABASE_URL"]
@@ -41,6 +149,37 @@ def get_supabase() -> Client:
 
 supabase = get_supabase()
 
+@st.cache_data(ttl=60)
+def fetch_responses(user_id: str) -> list[dict]:
+    data = supabase.table("responses")\
+        .select("question_idx, correct, created_at")\
+        .eq("user_id", user_id)\
+        .order("created_at", desc=False)\
+        .execute()
+    return data.data or []
+
+def save_responses(rows: list[dict]) -> bool:
+    if not rows:
+        return True
+    try:
+        supabase.table("responses")\
+            .insert(rows)\
+            .execute()
+    except Exception:
+        return False
+    fetch_responses.clear()
+    return True
+
+def flush_pending_writes(state) -> bool:
+    if not save_responses(state["pending_writes"]):
+        return False
+    state["pending_writes"] = []
+    return True
+
+@lru_cache(maxsize=64)
+def auth_error_message(msg: str) -> str:
+    return msg.strip() or "Authentication failed."
+
 def sign_up(email: str, password: str):
     return supabase.auth.sign_up({"email": email, "password": password})
 
@@ -52,9 +191,10 @@ stripe.api_key       = st.secrets["stripe_secret_key"]
 PRICE_ID             = st.secrets["STRIPE_PRICE_ID"]
 APP_BASE_URL         = st.secrets["APP_URL"]
 
-def create_checkout_session():
+@st.cache_data(ttl=3600)
+def checkout_url(user_email: str) -> str:
     sess = stripe.checkout.Session.create(
-        customer_email=st.session_state.user.email,
+        customer_email=user_email,
         line_items=[{"price": PRICE_ID, "quantity": 1}],
         mode="payment",
         success_url=f"{APP_BASE_URL}?session_id={{CHECKOUT_SESSION_ID}}",
@@ -63,19 +203,34 @@ def create_checkout_session():
     return sess.url
 
 def require_paid():
-    params = st.experimental_get_query_params()
-    if "session_id" in params:
-        session = stripe.checkout.Session.retrieve(params["session_id"][0])
-        if session.payment_status == "paid":
+    session_id = st.query_params.get("session_id")
+    if session_id and not st.session_state.checkout_seen:
+        try:
+            session = stripe.checkout.Session.retrieve(session_id)
+        except Exception:
+            st.error("⚠️ Couldn’t confirm your payment. Please refresh to try again.")
+            st.stop()
+        paid = session.payment_status == "paid"
+        if paid:
+            try:
+                supabase.table("users")\
+                    .update({"paid": True})\
+                    .eq("id", st.session_state.user.id)\
+                    .execute()
+            except Exception:
+                st.error("⚠️ Couldn’t save your payment. Please refresh to try again.")
+                st.stop()
             st.session_state.paid = True
-            supabase.table("users")\
-                .update({"paid": True})\
-                .eq("id", st.session_state.user.id)\
-                .execute()
-            st.experimental_rerun()
+            # this checkout is completed; never hand its URL out again
+            checkout_url.clear(st.session_state.user.email)
+        # fully handled; drop it from the URL
+        st.session_state.checkout_seen = True
+        st.query_params.clear()
+        if paid:
+            st.rerun()
 
     if not st.session_state.paid:
-        url = create_checkout_session()
+        url = checkout_url(st.session_state.user.email)
         st.sidebar.markdown("### 🔒 Subscriber Access")
         st.sidebar.markdown(f"[Subscribe for $39]({url})")
         st.stop()
@@ -91,11 +246,12 @@ def render_auth(_):
             st.error("Enter both email & password.")
             return
         res = sign_up(email, password) if mode == "Sign Up" else sign_in(email, password)
-        if getattr(res, "error", None):
-            st.error(res.error.message)
+        err = getattr(res, "error", None)
+        if err:
+            st.error(auth_error_message(err.message))
         else:
             st.success(f"{mode} successful!")
-            st.session_state.user = res.user
+            st.session_state.user = SimpleNamespace(id=res.user.id, email=res.user.email)
 
 def render_home(df):
     if not st.session_state.user:
@@ -106,7 +262,8 @@ def render_home(df):
     st.write("Choose a topic below or start practicing from the sidebar.")
 
     # Get topic counts as a list of tuples
-    topic_counts = list(df["topic"].value_counts().items())
+    counts, _    = topic_stats(df)
+    topic_counts = list(counts.items())
     num_topics = len(topic_counts)
 
     # Split into two roughly equal columns
@@ -122,49 +279,21 @@ def render_home(df):
         for topic, cnt in col2_topics:
             st.markdown(f"- **{topic}** ({cnt} questions)")
 
-def render_practice(df):
-    if not st.session_state.user:
-        st.error("🔒 Please log in on the Auth page.")
-        return
-    st.markdown("<h1>Practice Questions</h1>", unsafe_allow_html=True)
-
-    # Sidebar controls
-    mode      = st.sidebar.selectbox("Mode", ["Free Trial", "Full Quiz"])
-    test_mode = st.sidebar.radio("Test Mode", ["Tutor", "Test"])
-    topics    = ["All"] + sorted(df["topic"].unique())
-    chosen    = st.sidebar.selectbox("Topic", topics)
-
-    if not st.session_state.locked_mode:
-        def start_test():
-            subset = df if chosen == "All" else df[df["topic"] == chosen]
-            ids = subset.index.tolist()
-            random.shuffle(ids)
-            if mode == "Free Trial":
-                ids = ids[:50]
-            st.session_state.update({
-                "locked_mode":      mode,
-                "locked_test_mode": test_mode,
-                "question_list":    ids,
-                "responses":        [],
-                "current_q_idx":    0,
-                "total":            0,
-                "correct":          0,
-                "test_submitted":   False
-            })
-            if test_mode == "Test":
-                st.session_state.start_time = time.time()
-
-        st.sidebar.button("Start Test", on_click=start_test)
-        st.stop()
-
-    if st.session_state.locked_mode == "Full Quiz":
-        require_paid()
+@st.fragment
+def question_block(records):
+    # fragment reruns skip the top-level touch, so keep the session fresh here;
+    # the sweep itself only runs on full reruns
+    touch_session()
+    # an idle-session sweep may have dropped this test; restart from the app
+    if any(k not in st.session_state for k in HEAVY_KEYS):
+        init_state()
+        st.rerun()
 
     # Current question
     ids   = st.session_state.question_list
     idx   = st.session_state.current_q_idx
     total = len(ids)
-    q     = df.loc[ids[idx]]
+    q     = records[int(ids[idx])]
     tm    = st.session_state.locked_test_mode
 
     st.markdown(f"<div class='question-header'>Question {idx+1} of {total}</div>", unsafe_allow_html=True)
@@ -180,58 +309,116 @@ def render_practice(df):
         st.info(f"You selected **{last['selected']}**")
         if tm == "Tutor":
             with st.expander("Show Explanation"):
-                st.markdown(f"**Answer:** {q['answer']}  ")
+                st.markdown(f"**Answer:** {q['answer'].upper()}  ")
                 st.markdown(f"**Explanation:** {q['explanation']}")
     else:
-        for opt in ["a", "b", "c", "d"]:
-            if st.button(f"{opt.upper()}. {q[f'option_{opt}']}", key=f"ans{idx}{opt}"):
-                correct = (opt == q["answer"])
-                st.session_state.total += 1
-                if correct:
-                    st.session_state.correct += 1
-                st.session_state.responses.append({
-                    "question": q["question"],
-                    "selected": opt.upper(),
-                    "correct": q["answer"].upper(),
-                    "result":  "Correct" if correct else "Wrong"
-                })
-                # persist to Supabase
-                try:
-                    supabase.table("responses").insert({
-                        "user_id":      st.session_state.user.id,
-                        "question_idx": idx,
-                        "question":     q["question"],
-                        "selected":     opt.upper(),
-                        "correct":      correct
-                    }).execute()
-                except Exception:
-                    st.error("⚠️ Couldn’t save your answer.")
-                st.rerun()
+        with st.form(f"q{idx}"):
+            opt = st.radio(
+                "Answer",
+                ["a", "b", "c", "d"],
+                index=None,
+                format_func=lambda o: f"{o.upper()}. {q[f'option_{o}']}",
+            )
+            submitted = st.form_submit_button("Submit Answer")
+        if submitted and opt is None:
+            st.warning("Select an answer first.")
+        elif submitted:
+            correct = (opt == q["answer"])
+            row = {
+                "question": q["question"],
+                "selected": opt.upper(),
+                "correct": q["answer"].upper(),
+                "result":  "Correct" if correct else "Wrong"
+            }
+            # queued for Supabase, flushed on submit
+            write = {
+                "user_id":      st.session_state.user.id,
+                "question_idx": idx,
+                "question":     q["question"],
+                "selected":     opt.upper(),
+                "correct":      correct
+            }
+            st.session_state.update({
+                "total":          st.session_state.total + 1,
+                "correct":        st.session_state.correct + int(correct),
+                "responses":      st.session_state.responses + [row],
+                "pending_writes": st.session_state.pending_writes + [write]
+            })
+            st.rerun(scope="fragment")
 
     # Navigation buttons
     c1, _, c3 = st.columns([1, 6, 1])
     with c1:
         if st.button("⬅️ Back", disabled=idx == 0):
             st.session_state.current_q_idx -= 1
-            st.rerun()
+            st.rerun(scope="fragment")
     with c3:
         if st.button("➡️ Next", disabled=idx >= total - 1):
             st.session_state.current_q_idx += 1
-            st.rerun()
+            st.rerun(scope="fragment")
 
-    # Submit and results
+    # Submit
     if len(st.session_state.responses) == total:
         st.divider()
         if st.button("🚀 Submit Test"):
+            # persist to Supabase
+            if not flush_pending_writes(st.session_state):
+                st.error("⚠️ Couldn’t save your answers.")
+                st.stop()
             st.session_state.test_submitted = True
+            gc.collect()
             st.rerun()
 
+def render_practice(df):
+    if not st.session_state.user:
+        st.error("🔒 Please log in on the Auth page.")
+        return
+    st.markdown("<h1>Practice Questions</h1>", unsafe_allow_html=True)
+
+    # Sidebar controls
+    mode      = st.sidebar.selectbox("Mode", ["Free Trial", "Full Quiz"])
+    test_mode = st.sidebar.radio("Test Mode", ["Tutor", "Test"])
+    topics    = ["All"] + topic_stats(df)[1]
+    chosen    = st.sidebar.selectbox("Topic", topics)
+
+    if not st.session_state.locked_mode:
+        def start_test():
+            pool = df.index.to_numpy(dtype=np.int32) if chosen == "All" else topic_index(df)[chosen]
+            rng  = np.random.default_rng()
+            if mode == "Free Trial":
+                ids = rng.choice(pool, size=min(50, len(pool)), replace=False)
+            else:
+                ids = rng.permutation(pool)
+            st.session_state.update({
+                "locked_mode":      mode,
+                "locked_test_mode": test_mode,
+                "question_list":    ids,
+                "responses":        [],
+                "pending_writes":   [],
+                "current_q_idx":    0,
+                "total":            0,
+                "correct":          0,
+                "test_submitted":   False
+            })
+            if test_mode == "Test":
+                st.session_state.start_time = time.time()
+
+        st.sidebar.button("Start Test", on_click=start_test)
+        st.stop()
+
+    if st.session_state.locked_mode == "Full Quiz":
+        require_paid()
+
+    question_block(as_records(df))
+
+    # Results
+    total = len(st.session_state.question_list)
     if st.session_state.test_submitted:
         st.success("✅ Test submitted!")
         corr = st.session_state.correct
         acc  = (corr / total * 100) if total else 0
         st.write(f"**Total:** {total} | **Correct:** {corr} | **Accuracy:** {acc:.1f}%")
-        st.table(pd.DataFrame(st.session_state.responses))
+        st.dataframe(pa.Table.from_pylist(st.session_state.responses), use_container_width=True)
         if st.button("🔁 Restart"):
             for k in list(st.session_state.keys()):
                 del st.session_state[k]
@@ -241,12 +428,7 @@ def render_stats(_):
     if not st.session_state.user:
         st.error("🔒 Please log in on the Auth page.")
         return
-    data = supabase.table("responses")\
-        .select("question_idx, correct, created_at")\
-        .eq("user_id", st.session_state.user.id)\
-        .order("created_at", desc=False)\
-        .execute()
-    rows = data.data or []
+    rows    = fetch_responses(st.session_state.user.id)
     total   = len(rows)
     correct = sum(1 for r in rows if r["correct"])
     acc     = (correct / total * 100) if total else 0
@@ -257,18 +439,21 @@ def render_stats(_):
     st.metric("Accuracy", f"{acc:.1f}%")
 
     if rows:
-        hist = pd.DataFrame(rows)
-        hist["cumulative_accuracy"] = hist["correct"].expanding().mean()
-        hist.index = pd.to_datetime(hist["created_at"])
+        vals = np.fromiter((1 if r["correct"] else 0 for r in rows), dtype=np.int32, count=total)
+        hist = pd.DataFrame(
+            {"cumulative_accuracy": np.cumsum(vals) / np.arange(1, total + 1)},
+            index=pd.to_datetime([r["created_at"] for r in rows]),
+        )
         st.line_chart(hist["cumulative_accuracy"], height=250, use_container_width=True)
 
 # ── FINAL APP SETUP ───────────────────────────────────
 base_dir = os.path.dirname(__file__)
 df       = load_questions(os.path.join(base_dir, "questions.csv"))
 
-with open("style.css") as f:
-    st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+st.markdown(f"<style>{load_css('style.css')}</style>", unsafe_allow_html=True)
 
+touch_session()
+sweep_sessions()
 init_state()
 
 page = st.sidebar.radio("Navigation", ["Auth", "Home", "Practice", "Stats"])